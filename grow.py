@@ -1,29 +1,41 @@
 #!/usr/bin/env python3
 
-import glob
+import asyncio
+import html
 import logging
+import os
+import queue
 import subprocess
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
 
 import click
 from fasthtml.common import (
-    A,
-    Aside,
     Body,
     Div,
     FastHTML,
-    Li,
+    Head,
+    Html,
     Link,
     NotStr,
     P,
+    Response,
     Script,
     Section,
+    StreamingResponse,
     Style,
     Title,
-    Ul,
     serve,
+    to_xml,
 )
 import starlette.requests
 
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
 logger = logging.getLogger("uvicorn")
 
 
@@ -62,6 +74,8 @@ class Path:
         a/b
     """
 
+    __slots__ = ("path", "is_dir", "is_file")
+
     path: str
     is_dir: bool
     is_file: bool
@@ -71,7 +85,7 @@ class Path:
         if p == "":
             self.path = "."
             self.set_dir()
-        elif p.endswith(".md") or p.endswith(".mkd"):
+        elif p.endswith((".md", ".mkd")):
             self.path = p
             self.set_file()
         else:
@@ -86,7 +100,7 @@ class Path:
         """
         if self.is_dir:
             return self
-        return Path("/".join(self.path.split("/")[:-1]))
+        return Path(self.path.rpartition("/")[0])
 
     def set_dir(self):
         self.is_dir = True
@@ -106,9 +120,49 @@ class Path:
         return f"Path(path={self.path}, is_file={self.is_file}, is_dir={self.is_dir})"
 
 
+# filelist 結果の LRU キャッシュ
+# key は (path, ディレクトリ mtime) なので中身が変わらない限り走査しない
+_FILELIST_CACHE: OrderedDict[tuple[str, int], list["Path"]] = OrderedDict()
+_FILELIST_CACHE_SIZE = 512
+
+
+def _cache_get(cache: OrderedDict, key):
+    """LRU キャッシュから読んで末尾 (最近使った側) に移す
+
+    watcher スレッドが同時に entry を消すことがあるので
+    `key in cache` してから読む、はダメ (間で消えると KeyError で 500 になる)
+    """
+    if key is None:
+        return None
+    hit = cache.get(key)
+    if hit is not None:
+        try:
+            cache.move_to_end(key)
+        except KeyError:
+            pass
+    return hit
+
+
 class FileSystem:
     @staticmethod
-    def filelist(path: Path) -> list[Path]:
+    def _cache_key(root: str) -> tuple[str, int] | None:
+        """ディレクトリ mtime からキャッシュキーを作る
+
+        直下のディレクトリの mtime も XOR で混ぜて
+        1段ネストした追加・削除でもキーが変わるようにする
+        """
+        try:
+            token = os.stat(root).st_mtime_ns
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        token ^= entry.stat(follow_symlinks=False).st_mtime_ns
+        except OSError:
+            return None
+        return (root, token)
+
+    @staticmethod
+    def filelist(path: Path, key: tuple[str, int] | None = None) -> list[Path]:
         """markdown へのパス一覧を返す
 
         grow root からの相対パスで返す
@@ -121,125 +175,541 @@ class FileSystem:
         path
             ディレクトリへのパス
             この下を見る
+        key
+            計算済みのキャッシュキーがあれば渡す (stat の重複を省く)
         """
-        ls = []
-        ls += glob.glob("**/*.md", root_dir=str(path), recursive=True)
-        ls += glob.glob("**/*.mkd", root_dir=str(path), recursive=True)
-        ls = [f"{p.split("/")[0]}/" if "/" in p else p for p in ls]
-        ls = [".."] + sorted(set(ls))
-        ls = [Path(p) for p in ls]
+        if key is None:
+            key = FileSystem._cache_key(str(path))
+        if (hit := _cache_get(_FILELIST_CACHE, key)) is not None:
+            return hit
+
+        seen: set[str] = set()
+
+        def contains_md(dirpath: str) -> bool:
+            """dirpath 以下のどこかに markdown があるか
+
+            一覧に必要なのは有無だけなので1つ見つけた時点で打ち切る
+            """
+            try:
+                entries = os.scandir(dirpath)
+            except OSError:
+                return False
+            dirs = []
+            with entries:
+                for entry in entries:
+                    # glob 同様 dotfile / dot ディレクトリは見ない
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.name.endswith((".md", ".mkd")):
+                        return True
+            return any(contains_md(d) for d in dirs)
+
+        try:
+            with os.scandir(str(path)) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if contains_md(entry.path):
+                            seen.add(f"{entry.name}/")
+                    elif entry.name.endswith((".md", ".mkd")):
+                        seen.add(entry.name)
+        except OSError:
+            pass
+        ls = [Path(p) for p in [".."] + sorted(seen)]
         logger.info("filelist: %s => %s", path, ls)
+        if key is not None:
+            _FILELIST_CACHE[key] = ls
+            if len(_FILELIST_CACHE) > _FILELIST_CACHE_SIZE:
+                _FILELIST_CACHE.popitem(last=False)
         return ls
 
 
-def folder(path: Path):
+_FILE_ICON = '<i class="fa-regular fa-file"></i>'
+_FOLDER_ICON = '<i class="fa-regular fa-folder"></i>'
+
+# 構築済みサイドバーの LRU キャッシュ
+# サイドバーはディレクトリだけで決まるので同じフォルダのファイル間で共有できる
+_FOLDER_CACHE: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+_FOLDER_CACHE_SIZE = 512
+
+
+def folder(path: Path) -> bytes:
     """フォルダ内をレンダリングする
 
+    サイドバーは固定の単純なテンプレートなので FastHTML ノードを組まずに
+    文字列連結で直接 HTML を作る (ファイル数ぶんのオブジェクト生成を省く)
+    同じディレクトリなら構築済みの bytes をそのまま使い回す
+
     Parameters
     ----------
     path
         ファイルまたはディレクトリへのパス
         ファイルパスの場合はそれがあるフォルダを見る
     """
+    d = path.parent()
+    key = FileSystem._cache_key(str(d))
+    if (hit := _cache_get(_FOLDER_CACHE, key)) is not None:
+        return hit
+    parts = ['<aside class="menu"><ul class="menu-list">']
+    for p in FileSystem.filelist(d, key):
+        icon = _FILE_ICON if p.is_file else _FOLDER_ICON
+        href = html.escape(str(p), quote=True)
+        parts.append(f'<li><a href="{href}">{icon}{html.escape(str(p))}</a></li>')
+    parts.append("</ul></aside>")
+    blob = "".join(parts).encode()
+    if key is not None:
+        _FOLDER_CACHE[key] = blob
+        if len(_FOLDER_CACHE) > _FOLDER_CACHE_SIZE:
+            _FOLDER_CACHE.popitem(last=False)
+    return blob
+
+
+class UnidocWorker:
+    """常駐 unidoc プロセス
+
+    リクエストのたびに fork+exec しないよう `unidoc --server` を1度だけ起動して
+    パイプ越しに使い回す
+
+    プロトコル (行指向, 長さプレフィックス)
+        送信: "<path>\\n"
+        受信: "<status> <stdout長> <stderr長>\\n" + stdout + stderr
+
+    `--server` を知らない unidoc だと最初のやりとりで失敗するので
+    そのときは諦めて従来どおり1回ずつ subprocess.run する (render が None を返す)
+    """
 
-    def link(path: Path):
-        if path.is_file:
-            icon = '<i class="fa-regular fa-file"></i>'
-        else:
-            icon = '<i class="fa-regular fa-folder"></i>'
-        return A(NotStr(icon), path, href=str(path))
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proc: subprocess.Popen | None = None
+        self.disabled = False
+
+    def _ensure(self) -> subprocess.Popen | None:
+        if self.disabled:
+            return None
+        if self.proc is not None and self.proc.poll() is None:
+            return self.proc
+        try:
+            self.proc = subprocess.Popen(
+                ["unidoc", "--server"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                bufsize=0,
+            )
+        except OSError:
+            self.proc = None
+            self.disabled = True
+        return self.proc
 
-    ls = FileSystem.filelist(path.parent())
-    return Aside(Ul(*[Li(link(path)) for path in ls], cls="menu-list"), cls="menu")
+    @staticmethod
+    def _read_exact(proc: subprocess.Popen, n: int) -> bytes:
+        """stdout からちょうど n バイト読む
 
+        bufsize=0 の raw パイプでは read(n) が n バイト未満で返りうる
+        (パイプバッファの 64KB を超えると必ずそうなる) のでループで読み切る
+        """
+        buf = b""
+        while len(buf) < n:
+            chunk = proc.stdout.read(n - len(buf))
+            if not chunk:
+                raise OSError("unidoc worker closed stdout")
+            buf += chunk
+        return buf
+
+    def render(self, path: str) -> tuple[int, bytes, bytes] | None:
+        """常駐プロセスでコンパイルする
+
+        Returns
+        -------
+        (status, stdout, stderr)
+        常駐プロセスが使えないときは None
+        """
+        with self.lock:
+            proc = self._ensure()
+            if proc is None:
+                return None
+            try:
+                proc.stdin.write(path.encode() + b"\n")
+                status, n_out, n_err = map(int, proc.stdout.readline().split())
+                stdout = self._read_exact(proc, n_out)
+                stderr = self._read_exact(proc, n_err)
+                return (status, stdout, stderr)
+            except (OSError, ValueError):
+                proc.kill()
+                self.proc = None
+                self.disabled = True
+                return None
+
+
+class UnidocWorkerPool:
+    """UnidocWorker のプール
+
+    常駐プロセスを CPU コア数まで増やして
+    並列リクエストでもコンパイルが1プロセスに直列化しないようにする
+    worker は必要になったとき遅延で起動する
+    """
 
-def compile(path: Path) -> tuple[int, str, str]:
+    def __init__(self, size: int | None = None):
+        self.size = size or os.cpu_count() or 1
+        self.idle: queue.Queue[UnidocWorker] = queue.Queue()
+        self.spawned = 0
+        self.lock = threading.Lock()
+
+    def _acquire(self) -> UnidocWorker:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.spawned < self.size:
+                self.spawned += 1
+                return UnidocWorker()
+        # 全部出払っているときは返却を待つ
+        return self.idle.get()
+
+    def render(self, path: str) -> tuple[int, bytes, bytes] | None:
+        worker = self._acquire()
+        try:
+            return worker.render(path)
+        finally:
+            self.idle.put(worker)
+
+
+_WORKER = UnidocWorkerPool()
+
+
+# compile 結果の LRU キャッシュ
+# key は (path, mtime, size) なのでファイルが更新されたら自然に無効になる
+_COMPILE_CACHE: OrderedDict[tuple[str, float, int], tuple[int, bytes, bytes]] = OrderedDict()
+_COMPILE_CACHE_SIZE = 512
+
+
+def _compile_cache_key(
+    path: Path, st: os.stat_result | None = None
+) -> tuple[str, float, int] | None:
+    # st は呼び出し側が stat 済みならそれを使い回す (リクエスト中の stat は1回で済ます)
+    if st is None:
+        try:
+            st = os.stat(path.path)
+        except OSError:
+            return None
+    return (path.path, st.st_mtime, st.st_size)
+
+
+def _compile_cache_store(key, result):
+    if key is None:
+        return
+    _COMPILE_CACHE[key] = result
+    if len(_COMPILE_CACHE) > _COMPILE_CACHE_SIZE:
+        _COMPILE_CACHE.popitem(last=False)
+
+
+def compile(path: Path, st: os.stat_result | None = None) -> tuple[int, bytes, bytes]:
     """markdown をコンパイルする
 
+    同じファイル (mtime, size が同じ) なら unidoc を再実行せずキャッシュから返す
+
     Returns
     -------
     status
     stdout
     stderr
     """
-    proc = subprocess.run(["unidoc", str(path)], capture_output=True)
-    return (proc.returncode, proc.stdout.decode(), proc.stderr.decode())
+    key = _compile_cache_key(path, st)
+    if (hit := _cache_get(_COMPILE_CACHE, key)) is not None:
+        return hit
+    result = _WORKER.render(path.path)
+    if result is None:
+        proc = subprocess.run(["unidoc", str(path)], capture_output=True)
+        result = (proc.returncode, proc.stdout, proc.stderr)
+    _compile_cache_store(key, result)
+    return result
+
+
+def _notification(kind: str, text: str) -> bytes:
+    """Bulma の notification を直接 bytes で作る (リクエスト経路に to_xml を残さない)"""
+    return f'<div class="notification {kind}">{html.escape(text)}</div>'.encode()
+
+
+def _content_html(status: int, stdout: bytes, stderr: bytes) -> bytes:
+    """compile 結果を本文カラムの HTML にする
+
+    成功時の stdout はすでに HTML なので decode せずバイト列のまま連結する
+    (レスポンスはどうせ bytes で書くので decode/encode の往復が丸ごと無駄)
+    """
+    if status == 0:
+        return b'<div class="content">' + stdout + b"</div>"
+    return _notification("is-danger", stderr.decode(errors="replace"))
+
 
+def content_chunks(path: Path, st: os.stat_result | None = None):
+    """markdown 本文の HTML をチャンクで yield するジェネレータ
 
-def content(path: Path):
-    """markdown をレンダリングして返す
+    キャッシュか常駐 worker が使えるときは一括で yield する
+    どちらもないときは unidoc の stdout をバッファしきらず読んだそばから流す
 
     Parameters
     ----------
     path
         markdown へのファイルパス
         またはそれ以外のパス
-
-    Returns
-    -------
-    path がファイルパスのときは markdown ファイルだとして HTML レンダリングする
     """
     if not path.is_file:
-        return Div(
-            f"{path}",
-            cls="notification is-info",
+        yield _notification("is-info", str(path))
+        return
+    key = _compile_cache_key(path, st)
+    if (hit := _cache_get(_COMPILE_CACHE, key)) is not None:
+        yield _content_html(*hit)
+        return
+    result = _WORKER.render(path.path)
+    if result is not None:
+        _compile_cache_store(key, result)
+        yield _content_html(*result)
+        return
+    proc = subprocess.Popen(
+        ["unidoc", str(path)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    # stderr は別スレッドで吸い出しておく
+    # stdout だけ読んでいると stderr のパイプが詰まった時点で unidoc ごと止まる
+    stderr_chunks: list[bytes] = []
+    drain = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()))
+    drain.start()
+    chunks = []
+    for chunk in iter(lambda: proc.stdout.read(65536), b""):
+        if not chunks:
+            yield b'<div class="content">'
+        chunks.append(chunk)
+        yield chunk
+    drain.join()
+    stderr = b"".join(stderr_chunks)
+    proc.wait()
+    if chunks:
+        yield b"</div>"
+    # 失敗もキャッシュする (mtime が変わるまで unidoc を再実行しても結果は同じ)
+    _compile_cache_store(key, (proc.returncode, b"".join(chunks), stderr))
+    if proc.returncode != 0:
+        yield _notification("is-danger", stderr.decode(errors="replace"))
+
+
+def _shell_segments() -> list[bytes]:
+    """静的なシェル HTML を一度だけ組み立ててプレースホルダで分割する
+
+    リクエストごとに変わるのは path (タイトルとヒーロー), サイドバー, 本文だけ
+    残りは import 時にシリアライズして bytes 定数にしておき
+    render() では連結するだけにする
+    """
+    # to_xml は doctype を付けないので自前で付ける (ないと quirks mode になる)
+    shell = "<!doctype html>\n" + to_xml(
+        Html(
+            Head(Title("__PATH__ - grow.md"), *app.hdrs),
+            Body(
+                Section(
+                    Div(P("__PATH__", cls="title"), cls="hero-body"),
+                    cls="hero",
+                ),
+                Div(
+                    Div(
+                        Div(
+                            Div(NotStr("__FOLDER__"), cls="column is-two-fifths"),
+                            Div(NotStr("__CONTENT__"), cls="column"),
+                            cls="columns",
+                        ),
+                        cls="container",
+                    ),
+                    cls="section",
+                ),
+                **app.bodykw,
+            ),
         )
-    statuscode, stdout, stderr = compile(path)
-    if statuscode == 0:
-        return Div(NotStr(stdout), cls="content")
-    return Div(stderr, cls="notification is-danger")
+    )
+    segments = []
+    rest = shell
+    for mark in ("__PATH__", "__PATH__", "__FOLDER__", "__CONTENT__"):
+        seg, _, rest = rest.partition(mark)
+        segments.append(seg.encode())
+    segments.append(rest.encode())
+    return segments
 
 
-def render(req: starlette.requests.Request):
+async def render(req: starlette.requests.Request):
     path = Path(req.url.path)
     logger.info("path: %s", path)
-    hero = Section(
-        Div(P(path, cls="title"), cls="hero-body"),
-        cls="hero",
-    )
-    section = Div(
-        Div(
-            Div(
-                Div(folder(path), cls="column is-two-fifths"),
-                Div(content(path), cls="column"),
-                cls="columns",
-            ),
-            cls="container",
-        ),
-        cls="section",
-    )
-    return (
-        Title(f"{path} - grow.md"),
-        Body(hero, section),
+    headers = {}
+    # リクエスト中の stat はここの1回だけ
+    # 以降 (キャッシュキー, conditional GET) はこの結果を使い回す
+    st = None
+    if path.is_file:
+        try:
+            st = os.stat(path.path)
+        except OSError:
+            pass
+        if st is not None:
+            last_modified = formatdate(st.st_mtime, usegmt=True)
+            etag = f'W/"{st.st_mtime_ns}-{st.st_size}"'
+            # conditional GET: クライアントが持っているものが新しければ 304 で済ます
+            if (
+                req.headers.get("if-none-match") == etag
+                or req.headers.get("if-modified-since") == last_modified
+            ):
+                return Response(status_code=304)
+            headers = {
+                "Cache-Control": "no-cache",
+                "ETag": etag,
+                "Last-Modified": last_modified,
+            }
+    # folder はブロッキング I/O (scandir) なのでスレッドに逃がす
+    folder_html = await asyncio.to_thread(folder, path)
+    path_html = html.escape(str(path)).encode()
+
+    async def stream():
+        yield b"".join(
+            [_SHELL[0], path_html, _SHELL[1], path_html, _SHELL[2], folder_html, _SHELL[3]]
+        )
+        chunks = content_chunks(path, st)
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+        yield _SHELL[4]
+
+    return StreamingResponse(
+        stream(), media_type="text/html; charset=utf-8", headers=headers
     )
 
 
 app = make()
 
+# _SHELL[0] path _SHELL[1] path _SHELL[2] folder _SHELL[3] content _SHELL[4]
+_SHELL = _shell_segments()
+
+
+# 起動したバックグラウンドタスクへの参照
+# 持っておかないと asyncio のタスクは途中で GC されうる
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+def _spawn(coro):
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+
+
+async def _watch():
+    """ファイル変更を inotify (watchfiles) で受けてキャッシュを先回りで無効化する
+
+    これでリクエストのたびの mtime チェックがほぼ常にキャッシュヒットになる
+    (mtime キーそのものは安全弁として残す)
+
+    キャッシュにはリクエストスレッドが同時に触るので
+    snapshot を取ってから pop で消す (例外でこのタスクが死ぬと invalidation が止まる)
+    """
+    async for changes in awatch(".", recursive=True):
+        for _, p in changes:
+            rel = os.path.relpath(p)
+            for key in [k for k in list(_COMPILE_CACHE) if k[0] == rel]:
+                _COMPILE_CACHE.pop(key, None)
+        # サイドバーは祖先ディレクトリの一覧にも影響するので丸ごと捨てる
+        # (再構築は数回の stat + scandir で済む)
+        _FILELIST_CACHE.clear()
+        _FOLDER_CACHE.clear()
+
+
+if awatch is not None:
+
+    @app.on_event("startup")
+    async def _start_watcher():
+        _spawn(_watch())
+
+
+def all_markdown_files(root: str = ".") -> list[Path]:
+    """root 以下の markdown ファイルを全部列挙する
+
+    filelist 同様 dotfile / dot ディレクトリ (.git など) は見ない
+    """
+    found = []
+    for dirpath, dirnames, names in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for name in names:
+            if name.endswith((".md", ".mkd")) and not name.startswith("."):
+                found.append(Path(os.path.relpath(os.path.join(dirpath, name), root)))
+    return found
+
+
+# warmup で1回の unidoc にまとめて渡すファイル数と出力の区切り文字
+_BATCH_SIZE = 64
+_BATCH_SEP = b"\x1e"
+
+
+def _compile_batch(files: list[Path]) -> bool:
+    """複数ファイルを1回の unidoc 呼び出しでまとめてコンパイルする
+
+    fork+exec を N 回から 1 回に減らす warmup 専用の高速化
+
+    Returns
+    -------
+    batch モードが使えて結果をキャッシュに入れられたら True
+    (batch を知らない unidoc なら False なので1ファイルずつにフォールバックする)
+    """
+    keys = [_compile_cache_key(p) for p in files]
+    proc = subprocess.run(
+        ["unidoc", "--batch", "--sep", "\x1e", *[p.path for p in files]],
+        capture_output=True,
+    )
+    if proc.returncode != 0:
+        return False
+    parts = proc.stdout.split(_BATCH_SEP)
+    if len(parts) != len(files):
+        return False
+    for key, part in zip(keys, parts):
+        _compile_cache_store(key, (0, part, b""))
+    return True
+
+
+async def _warm():
+    """compile キャッシュを並列に温める
+
+    CPU コア数ぶん並列で unidoc を走らせて
+    初回アクセスでもキャッシュヒットと同じ速さにする
+    """
+    sem = asyncio.Semaphore(os.cpu_count() or 1)
+    files = all_markdown_files()
+    chunks = [files[i : i + _BATCH_SIZE] for i in range(0, len(files), _BATCH_SIZE)]
 
-@app.route("/{_a}")
-def get_1(req: starlette.requests.Request):
-    return render(req)
+    async def batch(chunk: list[Path]) -> bool:
+        async with sem:
+            return await asyncio.to_thread(_compile_batch, chunk)
 
+    async def one(p: Path):
+        async with sem:
+            await asyncio.to_thread(compile, p)
 
-@app.route("/{_a}/{_b}")
-def get_2(req: starlette.requests.Request):
-    return render(req)
+    results = await asyncio.gather(*(batch(chunk) for chunk in chunks))
+    rest = [p for ok, chunk in zip(results, chunks) if not ok for p in chunk]
+    await asyncio.gather(*(one(p) for p in rest))
+    logger.info("warmed %d files", len(files))
 
 
-@app.route("/{_a}/{_b}/{_c}")
-def get_3(req: starlette.requests.Request):
-    return render(req)
+@app.on_event("startup")
+async def _start_warm():
+    # --warm は uvicorn の worker プロセスに環境変数で伝わる
+    if os.environ.get("GROW_WARM"):
+        _spawn(_warm())
 
 
-@app.route("/{_a}/{_b}/{_c}/{_d}")
-def get_4(req: starlette.requests.Request):
-    return render(req)
+@app.route("/{path:path}")
+async def get(req: starlette.requests.Request):
+    return await render(req)
 
 
 @click.command
 @click.option("--port", "-p", type=int, default=8080)
-def main(port: int):
+@click.option("--warm", is_flag=True, default=False, help="起動時に全 markdown を事前コンパイルする")
+def main(port: int, warm: bool):
+    if warm:
+        os.environ["GROW_WARM"] = "1"
     serve(port=port)
 
 